@@ -3,18 +3,655 @@ import streamlit as st
 import sys
 from tenacity import retry, stop_after_attempt, wait_exponential
 
-# Workaround for sqlite3 version issue
-__import__('pysqlite3')
-sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+# Workaround for sqlite3 version issue, applied once per process (the pop would
+# otherwise force pysqlite3 to be re-imported on every rerun)
+if "sqlite3" not in sys.modules or sys.modules["sqlite3"].__name__ != "pysqlite3":
+    __import__('pysqlite3')
+    sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
-from crewai import Agent, Task, Crew
-from langchain_huggingface import HuggingFaceEndpoint
+import asyncio
+import functools
+import hashlib
+import importlib.metadata
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.caches import BaseCache
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import os
 
+# crewai, langchain_huggingface, sentence_transformers, numpy and the HTTP stack are imported
+# inside the functions that need them so plain reruns don't pay for them. Only the langchain_core
+# base classes subclassed below stay at module level; the endpoint needs langchain_core on every
+# page load anyway.
+
+logger = logging.getLogger("radio_jingle")
+
+# Mistral 7B Instruct on serverless HF Inference by default. For production, point HF_ENDPOINT_URL at a
+# dedicated Inference Endpoint / TGI deployment serving a quantized build, e.g.
+#   text-generation-launcher --model-id mistralai/Mistral-7B-Instruct-v0.3 --quantize awq \
+#       --max-batch-prefill-tokens 4096 --max-concurrent-requests 64 \
+#       --speculate 4 --max-batch-total-tokens <tuned to the GPU>
+# --speculate enables speculative decoding (n-gram drafts, or Medusa heads when the model ships them),
+# which suits short, repetitive jingle text. It is server-side only: the client just uses the endpoint URL.
+DEFAULT_ENDPOINT_URL = "https://api-inference.huggingface.co/models/mistralai/Mistral-7B-Instruct-v0.3"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "/tmp/llm_cache.db")
+# Embeddings are stored as <path>.npy and the matching results as <path>.json
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "/tmp/jingle_semantic_cache")
+SEMANTIC_CACHE_THRESHOLD = 0.92
+RESEARCH_CACHE_TTL = 86400
+RESEARCH_CACHE_MAX_ENTRIES = 1000
+STAGE_LABELS = ("Research Findings", "Initial Creation", "Final Polished Jingle")
+
+BATCH_RESEARCH_PROMPT = (
+    "<s>[INST] You are an expert researcher. Focus on fun, engaging, and relevant info for radio ads.\n\n"
+    "For each theme below, list 5 key points for an engaging jingle. Return only a JSON array with one "
+    "bullet-point string per theme, in the same order as the themes.\n\nThemes:\n{themes} [/INST]"
+)
+
+# Single-pass mode: one request does research, draft and polish, split on these section markers
+SECTION_MARKERS = ("### RESEARCH ###", "### DRAFT ###", "### FINAL ###")
+SINGLE_PASS_MAX_NEW_TOKENS = 1200
+SINGLE_PASS_PROMPT = (
+    "<s>[INST] You are a radio advertising team: a researcher, a jingle creator and a copywriter. "
+    "Jingles are rhythmic, memorable, under 30 seconds worth of content, persuasive and optimized for spoken delivery.\n\n"
+    "Work in three steps and start each with its marker line exactly as shown:\n"
+    "### RESEARCH ###\nA bullet-point list of 5 key points for an engaging jingle.\n"
+    "### DRAFT ###\nThe jingle lyrics with structure (e.g., verse, chorus) and notes on rhythm/timing.\n"
+    "### FINAL ###\nThe draft refined for flow, punch and radio delivery: the final polished jingle script.\n\n"
+    "Theme: {theme} [/INST]"
+)
+SINGLE_PASS_PATTERN = re.compile(
+    r"### RESEARCH ###(.*?)### DRAFT ###(.*?)### FINAL ###(.*)", re.S
+)
+
+# CrewAI puts the persona in the system message, which format_mistral_prompt places at the front of
+# the prompt; keep these byte-identical across runs so the endpoint can reuse the cached prefix.
+RESEARCHER_PERSONA = dict(
+    role="Researcher",
+    goal="Research key facts, trends, and appealing elements about the theme to inspire the jingle.",
+    backstory="You are an expert researcher with access to vast knowledge on various topics. Focus on fun, engaging, and relevant info for radio ads.",
+)
+CREATOR_PERSONA = dict(
+    role="Jingle Creator",
+    goal="Create a short, catchy radio jingle based on research, including lyrics and simple structure suggestions.",
+    backstory="You are a creative genius specializing in audio ads. Make it rhythmic, memorable, and under 30 seconds worth of content.",
+)
+COPYWRITER_PERSONA = dict(
+    role="Copywriter",
+    goal="Refine and polish the jingle content for clarity, impact, and radio-friendliness.",
+    backstory="You are a professional copywriter with experience in advertising. Ensure it's persuasive, error-free, and optimized for spoken delivery.",
+)
+
+
+class SQLiteLLMCache(BaseCache):
+    """LLM response cache persisted in SQLite, keyed by SHA-256 of the model settings and prompt."""
+
+    def __init__(self, database_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(database_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, generations TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def cache_key(prompt, llm_string):
+        # llm_string carries the endpoint, temperature, top_p, etc.
+        payload = json.dumps({"llm": llm_string, "prompt": prompt}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt, llm_string):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT generations FROM llm_cache WHERE key = ?", (self.cache_key(prompt, llm_string),)
+            ).fetchone()
+        if row is None:
+            return None
+        from langchain_core.outputs import Generation
+
+        return [Generation(text=text) for text in json.loads(row[0])]
+
+    def update(self, prompt, llm_string, return_val):
+        generations = json.dumps([generation.text for generation in return_val])
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, generations) VALUES (?, ?)",
+                (self.cache_key(prompt, llm_string), generations)
+            )
+            self._conn.commit()
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+
+@st.cache_resource
+def get_llm_cache():
+    return SQLiteLLMCache(LLM_CACHE_PATH)
+
+
+class SemanticJingleCache:
+    """Reuses jingles for near-duplicate themes, matched by cosine similarity of theme embeddings.
+
+    Entries are stored with a scope (the mode and endpoint that produced them); a lookup only
+    matches entries whose scope equals its own.
+    """
+
+    def __init__(self, path, embedder, threshold=SEMANTIC_CACHE_THRESHOLD):
+        import numpy as np
+
+        self._matrix_path = f"{path}.npy"
+        self._results_path = f"{path}.json"
+        self._embedder = embedder
+        self._threshold = threshold
+        self._lock = threading.Lock()
+        dimension = embedder.get_sentence_embedding_dimension()
+        self._matrix = np.empty((0, dimension), dtype=np.float32)
+        self._entries = []
+        if os.path.exists(self._matrix_path) and os.path.exists(self._results_path):
+            # Plain arrays and JSON only, so a tampered cache file can't execute code
+            matrix = np.load(self._matrix_path, allow_pickle=False)
+            with open(self._results_path, encoding="utf-8") as f:
+                entries = json.load(f)
+            # Ignore a cache written by a different embedder or left half-written
+            if (matrix.ndim == 2 and matrix.shape == (len(entries), dimension)
+                    and all(isinstance(entry, dict) for entry in entries)):
+                self._matrix = matrix.astype(np.float32)
+                self._entries = entries
+
+    def _embed(self, theme):
+        import numpy as np
+
+        return self._embedder.encode([theme], normalize_embeddings=True).astype(np.float32)
+
+    def lookup(self, theme, **scope):
+        vector = self._embed(theme)
+        with self._lock:
+            candidates = [
+                i for i, entry in enumerate(self._entries)
+                if all(entry.get(key) == value for key, value in scope.items())
+            ]
+            if not candidates:
+                return None
+            sims = self._matrix[candidates] @ vector[0]
+            # Prefer the newest entry on ties, so a regenerated jingle replaces the older one
+            best = len(candidates) - 1 - int(sims[::-1].argmax())
+            return tuple(self._entries[candidates[best]]["result"]) if sims[best] > self._threshold else None
+
+    def add(self, theme, result, **scope):
+        import numpy as np
+
+        vector = self._embed(theme)
+        with self._lock:
+            self._matrix = np.vstack([self._matrix, vector])
+            self._entries.append({**scope, "result": list(result)})
+            np.save(self._matrix_path, self._matrix, allow_pickle=False)
+            with open(self._results_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f)
+
+
+@st.cache_resource
+def get_embedder():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer("all-MiniLM-L6-v2")
+
+
+@st.cache_resource
+def get_semantic_cache():
+    return SemanticJingleCache(SEMANTIC_CACHE_PATH, get_embedder())
+
+
+class TokenQueueHandler(BaseCallbackHandler):
+    """Pushes streamed tokens onto a shared deque, tagged with the crew stage that produced them."""
+
+    def __init__(self, tokens, stage):
+        self.tokens = tokens
+        self.stage = stage
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens.append((self.stage, token))
+
+
+def format_mistral_prompt(messages):
+    """Render CrewAI chat messages as a Mistral-instruct prompt for the text-generation endpoint.
+
+    Mistral has no system role, so system and user text are folded into one [INST] block, system first.
+    """
+    if isinstance(messages, str):
+        messages = [{"role": "user", "content": messages}]
+    prompt, instruction = "<s>", []
+    for message in messages:
+        if message["role"] == "assistant":
+            prompt += "[INST] " + "\n\n".join(instruction) + " [/INST]" + message["content"] + "</s>"
+            instruction = []
+        else:
+            instruction.append(message["content"])
+    if instruction:
+        prompt += "[INST] " + "\n\n".join(instruction) + " [/INST]"
+    return prompt
+
+
+@functools.cache
+def endpoint_crew_llm_class():
+    """Build the CrewAI LLM adapter on first use, so crewai is only imported once a crew runs."""
+    from crewai import BaseLLM
+
+    class EndpointCrewLLM(BaseLLM):
+        """Sends CrewAI agent calls through the LangChain HF endpoint.
+
+        crewai rebuilds a LiteLLM client from any LangChain object it is given, dropping its callbacks
+        and cache; a BaseLLM is used as-is, so token streaming and the LLM cache apply to crew calls.
+        """
+
+        def __init__(self, llm, callbacks=None):
+            super().__init__(model=llm.endpoint_url, temperature=llm.temperature)
+            self.llm = llm
+            self.callbacks = callbacks or []
+
+        def call(self, messages, tools=None, callbacks=None, available_functions=None, **kwargs):
+            return self.llm.invoke(
+                format_mistral_prompt(messages), stop=self.stop or None, config={"callbacks": self.callbacks}
+            )
+
+    return EndpointCrewLLM
+
+
+class SectionTokenHandler(TokenQueueHandler):
+    """Tags tokens from a single-pass generation with the stage of the section they fall in.
+
+    The marker lines themselves are dropped. Text that could be the start of a marker is held
+    back until the next token shows whether it is one.
+    """
+
+    def __init__(self, tokens):
+        super().__init__(tokens, 0)
+        self.pending = ""
+
+    def _emit(self, text):
+        if text:
+            self.tokens.append((self.stage, text))
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.pending += token
+        while True:
+            found = [
+                (self.pending.find(marker), i) for i, marker in enumerate(SECTION_MARKERS) if marker in self.pending
+            ]
+            if not found:
+                break
+            start, stage = min(found)
+            self._emit(self.pending[:start])
+            self.stage = stage
+            self.pending = self.pending[start + len(SECTION_MARKERS[stage]):]
+        held = max(
+            (n for n in range(1, len(self.pending) + 1)
+             if any(marker.startswith(self.pending[-n:]) for marker in SECTION_MARKERS)),
+            default=0
+        )
+        self._emit(self.pending[:len(self.pending) - held])
+        self.pending = self.pending[len(self.pending) - held:]
+
+    def on_llm_end(self, response, **kwargs):
+        self._emit(self.pending)
+        self.pending = ""
+
+
+class DebugRecordFilter(logging.Filter):
+    """Passes only records logged with extra={"debug": True}, i.e. from a session with Debug ticked."""
+
+    def filter(self, record):
+        return getattr(record, "debug", False)
+
+
+@st.cache_resource
+def init_logging():
+    # Warnings and errors from this app always go to stderr. Records from sessions with Debug
+    # ticked also go to a plain RichHandler, down to DEBUG. The app logger doesn't propagate, so
+    # a configured root logger doesn't print them twice. CrewAI's own verbose output goes through
+    # its printer, not logging; it follows the same Debug toggle.
+    from rich.logging import RichHandler
+
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.WARNING)
+    debug_handler = RichHandler(markup=False, show_time=False)
+    debug_handler.addFilter(DebugRecordFilter())
+    logger.addHandler(handler)
+    logger.addHandler(debug_handler)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    return logger
+
+
+@st.cache_resource
+def init_http_pool():
+    import requests
+    from huggingface_hub import configure_http_backend
+    from requests.adapters import HTTPAdapter
+
+    # huggingface_hub keeps one requests.Session per thread (sessions aren't thread-safe); give every
+    # session the same keep-alive adapter so all threads reuse one pool of TLS connections
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+
+    def backend_factory():
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    configure_http_backend(backend_factory=backend_factory)
+    return adapter
+
+
+@st.cache_resource
+def init_llm(api_key, endpoint_url, use_cache):
+    from langchain_huggingface import HuggingFaceEndpoint
+
+    # The response cache is set per instance, one cached endpoint per setting, so a session's
+    # toggle doesn't change the cache for other sessions
+    return HuggingFaceEndpoint(
+        endpoint_url=endpoint_url,
+        huggingfacehub_api_token=api_key,
+        max_new_tokens=500,
+        temperature=0.7,
+        top_p=0.9,
+        timeout=30,
+        streaming=True,
+        cache=get_llm_cache() if use_cache else False
+    )
+
+
+class ResearchCache:
+    """Research findings per (theme, model), shared by single-theme and batch runs.
+
+    Research does not depend on the creative steps, so a regenerated jingle reuses it.
+    """
+
+    def __init__(self, ttl=RESEARCH_CACHE_TTL, max_entries=RESEARCH_CACHE_MAX_ENTRIES):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, theme, model_name):
+        with self._lock:
+            entry = self._entries.get((theme, model_name))
+            if entry is None or time.monotonic() - entry[0] > self._ttl:
+                return None
+            return entry[1]
+
+    def put(self, theme, model_name, research):
+        with self._lock:
+            self._entries[(theme, model_name)] = (time.monotonic(), research)
+            self._entries.move_to_end((theme, model_name))
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+@st.cache_resource
+def get_research_cache():
+    return ResearchCache()
+
+
+@st.cache_resource
+def get_revisions():
+    # Current revision per (theme, mode, model). Regenerate bumps it, so the cached generate
+    # functions miss once and every session then gets the new jingle.
+    return {}
+
+
+def do_research(theme, model_name, crew_llm, verbose=False):
+    """Run the researcher alone for a theme, reusing cached findings for the same (theme, model)."""
+    from crewai import Agent, Task
+
+    research_cache = get_research_cache()
+    research = research_cache.get(theme, model_name)
+    if research is not None:
+        return research
+
+    researcher = Agent(
+        **RESEARCHER_PERSONA,
+        verbose=verbose,
+        llm=crew_llm
+    )
+
+    research_task = Task(
+        description=f"Research '{theme}'. List 5 key points for an engaging jingle.",
+        expected_output="A bullet-point list of research findings.",
+        agent=researcher
+    )
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+    def run_research():
+        try:
+            return researcher.execute_task(research_task)
+        except Exception as inner_e:
+            raise Exception(f"Research failed: {str(inner_e)}")
+
+    research = str(run_research())
+    research_cache.put(theme, model_name, research)
+    return research
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def generate_jingle(theme, model_name, revision, _llm, _tokens=None, research=None, _verbose=False):
+    """Run the crew for a theme and return (research, creation, final) as plain strings.
+
+    Cached per theme, endpoint (model_name), revision and any given research. When a deque is
+    passed as _tokens, each agent streams its tokens into it as (stage, token). When research is
+    not given, it comes from do_research.
+    """
+    from crewai import Agent, Task, Crew
+
+    def agent_llm(stage):
+        callbacks = [TokenQueueHandler(_tokens, stage)] if _tokens is not None else None
+        return endpoint_crew_llm_class()(_llm, callbacks)
+
+    if research is None:
+        research = do_research(theme, model_name, agent_llm(0), _verbose)
+
+    # Define Agents
+    creator = Agent(
+        **CREATOR_PERSONA,
+        verbose=_verbose,
+        llm=agent_llm(1)
+    )
+
+    copywriter = Agent(
+        **COPYWRITER_PERSONA,
+        verbose=_verbose,
+        llm=agent_llm(2)
+    )
+
+    # Define Tasks
+    create_task = Task(
+        description=f"Using this research:\n{research}\n\nCreate a short radio jingle for '{theme}'. Include lyrics and notes on rhythm/timing.",
+        expected_output="The jingle lyrics with structure (e.g., verse, chorus). Keep it concise.",
+        agent=creator
+    )
+
+    copywrite_task = Task(
+        description=f"Refine the created jingle for '{theme}'. Improve flow, add punch, ensure it's radio-ready.",
+        expected_output="The final polished jingle script.",
+        agent=copywriter,
+        context=[create_task]
+    )
+
+    # Assemble Crew
+    crew = Crew(
+        agents=[creator, copywriter],
+        tasks=[create_task, copywrite_task],
+        verbose=_verbose
+    )
+
+    # Run the crew with retry logic
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+    async def run_crew():
+        try:
+            return await crew.kickoff_async()
+        except Exception as inner_e:
+            raise Exception(f"Crew execution failed: {str(inner_e)}")
+
+    result = asyncio.run(run_crew())
+    return research, create_task.output.raw, str(result)
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def generate_jingle_fast(theme, model_name, revision, _llm, _tokens=None):
+    """Generate (research, creation, final) for a theme with a single LLM request.
+
+    Cached per theme, endpoint (model_name) and revision.
+    """
+    config = {"callbacks": [SectionTokenHandler(_tokens)]} if _tokens is not None else None
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+    def run_prompt():
+        # No in-process micro-batching here: the HF text-generation API takes one prompt per request
+        # (no array input), and TGI already batches concurrent requests on the server (continuous batching)
+        return _llm.invoke(
+            SINGLE_PASS_PROMPT.format(theme=theme), max_new_tokens=SINGLE_PASS_MAX_NEW_TOKENS, config=config
+        )
+
+    match = SINGLE_PASS_PATTERN.search(run_prompt())
+    if not match:
+        raise ValueError("The model response did not contain the research, draft and final sections.")
+    research, creation, final = (section.strip() for section in match.groups())
+    return research, creation, final
+
+
+def with_script_ctx(fn):
+    """Wrap fn so it runs with the current Streamlit script context when called from a worker thread."""
+    ctx = get_script_run_ctx()
+
+    def wrapper(*args, **kwargs):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def parse_json_array(text, length):
+    """Return the first JSON array with length items found in text, or None.
+
+    Decoding is non-strict so raw newlines inside the strings (bullet lists) are accepted.
+    """
+    decoder = json.JSONDecoder(strict=False)
+    for match in re.finditer(r"\[", text):
+        try:
+            value, _ = decoder.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            continue
+        if isinstance(value, list) and len(value) == length:
+            return value
+    return None
+
+
+async def research_themes(themes, llm, verbose=False):
+    """Research several themes, returning one findings string per theme.
+
+    Themes without cached research are researched together in a single LLM request.
+    """
+    research_cache = get_research_cache()
+    findings = {theme: research_cache.get(theme, llm.endpoint_url) for theme in themes}
+    missing = [theme for theme in themes if findings[theme] is None]
+    if not missing:
+        return [findings[theme] for theme in themes]
+
+    prompt = BATCH_RESEARCH_PROMPT.format(themes="\n".join(f"- {theme}" for theme in missing))
+    response = await llm.ainvoke(prompt)
+    batch = parse_json_array(response, len(missing))
+    if batch is not None:
+        for theme, research in zip(missing, batch):
+            findings[theme] = str(research)
+            research_cache.put(theme, llm.endpoint_url, findings[theme])
+    else:
+        # Research each theme on its own rather than failing the whole batch
+        logger.warning("Batch research response was not a JSON array per theme", extra={"debug": verbose})
+        worker = with_script_ctx(do_research)
+        batch = await asyncio.gather(*[
+            asyncio.to_thread(worker, theme, llm.endpoint_url, endpoint_crew_llm_class()(llm), verbose)
+            for theme in missing
+        ])
+        findings.update(zip(missing, batch))
+    return [findings[theme] for theme in themes]
+
+
+async def generate_batch(themes, revisions, llm, high_quality, verbose=False):
+    """Generate jingles for several themes concurrently.
+
+    In high-quality mode uncached research for all themes is done in one request before the
+    create/copywrite crews run.
+    """
+    if not high_quality:
+        worker = with_script_ctx(generate_jingle_fast)
+        return await asyncio.gather(*[
+            asyncio.to_thread(worker, theme, llm.endpoint_url, revisions[theme], llm) for theme in themes
+        ])
+
+    findings = await research_themes(themes, llm, verbose)
+    worker = with_script_ctx(generate_jingle)
+    return await asyncio.gather(*[
+        asyncio.to_thread(worker, theme, llm.endpoint_url, revisions[theme], llm, None, research, verbose)
+        for theme, research in zip(themes, findings)
+    ])
+
+
+def stream_jingle(generate, theme, revision, llm):
+    """Run generate in a worker thread, rendering each stage's tokens in its own placeholder."""
+    tokens = deque()
+    placeholders = [st.empty() for _ in STAGE_LABELS]
+    texts = ["" for _ in STAGE_LABELS]
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(with_script_ctx(generate), theme, llm.endpoint_url, revision, llm, tokens)
+            while not future.done() or tokens:
+                if not tokens:
+                    time.sleep(0.05)
+                    continue
+                updated = set()
+                while tokens:
+                    stage, token = tokens.popleft()
+                    texts[stage] += token
+                    updated.add(stage)
+                for stage in updated:
+                    placeholders[stage].markdown(f"**{STAGE_LABELS[stage]}**\n\n{texts[stage]}")
+            return future.result()
+    finally:
+        # Clear the partial output on failure too, so it doesn't linger above the error
+        for placeholder in placeholders:
+            placeholder.empty()
+
+
+@st.fragment
+def render_outputs():
+    """Render the stored jingles; as a fragment, interacting here doesn't rerun the whole script."""
+    outputs = st.session_state.get("outputs", ())
+    for theme, research, creation, final in outputs:
+        if len(outputs) > 1:
+            st.header(theme)
+        st.subheader("Final Polished Jingle")
+        st.code(final, language=None)
+
+        # Optional: Display intermediate results
+        with st.expander("View Research Findings"):
+            st.code(research, language=None)
+        with st.expander("View Initial Creation"):
+            st.code(creation, language=None)
+
+
 # Set up the page
 st.title("Radio Jingle Generator using CrewAI and SLM")
 st.markdown("""
-This app uses CrewAI with a Small Language Model (Mistral 7B) to generate short radio jingles. It includes:
+This app uses a Small Language Model (Mistral 7B) to generate short radio jingles. By default a single
+request researches, drafts and polishes the jingle; high-quality mode runs a CrewAI crew instead:
 - **Researcher AI**: Researches the theme or product.
 - **Creator AI**: Creates the initial jingle lyrics and structure.
 - **Copywriter AI**: Polishes and refines the content for radio.
@@ -31,115 +668,92 @@ if not hf_api_key.startswith("hf_"):
     st.error("Invalid Hugging Face API token. It should start with 'hf_'. Please check and update the token in Streamlit secrets.")
     st.stop()
 
-# Check Python version
-py_version = sys.version_info
-if py_version.major == 3 and py_version.minor > 11:
-    st.warning(f"Running on Python {py_version.major}.{py_version.minor}. Python 3.11 is recommended for compatibility.")
+# Environment checks, once per session
+if "env_checked" not in st.session_state:
+    # Check Python version
+    py_version = sys.version_info
+    if py_version.major == 3 and py_version.minor > 11:
+        st.warning(f"Running on Python {py_version.major}.{py_version.minor}. Python 3.11 is recommended for compatibility.")
+
+    # Check pip version
+    pip_version = importlib.metadata.version("pip")
+    if pip_version < "25.2":
+        st.warning(f"Using pip {pip_version}. Consider updating to 25.2 or later for better dependency resolution.")
+    st.session_state["env_checked"] = True
 
-# Check pip version
-import pip
-pip_version = pip.__version__
-if pip_version < "25.2":
-    st.warning(f"Using pip {pip_version}. Consider updating to 25.2 or later for better dependency resolution.")
+# Sidebar options
+enable_cache = st.sidebar.checkbox("Cache LLM responses on disk", value=True)
+high_quality = st.sidebar.checkbox("High-quality mode (three CrewAI agents)", value=False)
+debug = st.sidebar.checkbox("Debug", value=False)
+init_logging()
 
 # LLM setup with Mistral 7B
 try:
-    llm = HuggingFaceEndpoint(
-        endpoint_url="https://api-inference.huggingface.co/models/mixtral-8x7b-instruct-v0.1",
-        huggingfacehub_api_token=hf_api_key,
-        max_new_tokens=500,
-        temperature=0.7,
-        top_p=0.9,
-        model_kwargs={"retry_on_rate_limit": True},  # Moved to model_kwargs
-        timeout=30
-    )
-    # Test the endpoint with a simple query
-    test_response = llm.invoke("Test connection to Hugging Face API")
-    st.write("Hugging Face API connection successful! Response: " + test_response[:100] + "...")
+    endpoint_url = st.secrets.get("HF_ENDPOINT_URL") or os.getenv("HF_ENDPOINT_URL") or DEFAULT_ENDPOINT_URL
+    init_http_pool()
+    llm = init_llm(hf_api_key, endpoint_url, enable_cache)
+    # Test the endpoint with a simple query, once per session (past the response cache)
+    if "connection_tested" not in st.session_state:
+        test_response = init_llm(hf_api_key, endpoint_url, False).invoke("Test connection to Hugging Face API")
+        st.session_state["connection_tested"] = True
+        st.write("Hugging Face API connection successful! Response: " + test_response[:100] + "...")
 except Exception as e:
     st.error(f"Failed to initialize SLM: {str(e)}")
     st.stop()
 
 # User input
-theme = st.text_input("Enter the theme or product for the radio jingle:", "Example: Summer Beach Party")
-generate_button = st.button("Generate Jingle")
+# Inside a form, typing does not rerun the script; only submitting does
+with st.form("gen"):
+    themes_input = st.text_area("Enter the themes or products for the radio jingles (one per line):", "Example: Summer Beach Party")
+    generate_button = st.form_submit_button("Generate Jingle")
+    if high_quality:
+        regenerate_button = st.form_submit_button("Regenerate (new jingle, same research)")
+    else:
+        regenerate_button = st.form_submit_button("Regenerate (new jingle)")
+themes = list(dict.fromkeys(line.strip() for line in themes_input.splitlines() if line.strip()))
 
-if generate_button and theme:
+if (generate_button or regenerate_button) and themes:
+    # Drop the previous results so they don't render under an error from this run
+    st.session_state.pop("outputs", None)
     with st.spinner("Assembling the crew and generating your jingle..."):
         try:
-            # Define Agents
-            researcher = Agent(
-                role="Researcher",
-                goal="Research key facts, trends, and appealing elements about the theme to inspire the jingle.",
-                backstory="You are an expert researcher with access to vast knowledge on various topics. Focus on fun, engaging, and relevant info for radio ads.",
-                verbose=True,
-                llm=llm
-            )
+            mode = "high_quality" if high_quality else "single_pass"
+            semantic_cache = get_semantic_cache() if enable_cache else None
+            results = {}
+            if semantic_cache and not regenerate_button:
+                for theme in themes:
+                    cached = semantic_cache.lookup(theme, mode=mode, endpoint_url=endpoint_url)
+                    if cached:
+                        results[theme] = cached
 
-            creator = Agent(
-                role="Jingle Creator",
-                goal="Create a short, catchy radio jingle based on research, including lyrics and simple structure suggestions.",
-                backstory="You are a creative genius specializing in audio ads. Make it rhythmic, memorable, and under 30 seconds worth of content.",
-                verbose=True,
-                llm=llm
-            )
+            pending = [theme for theme in themes if theme not in results]
+            logger.debug("Generating %d of %d theme(s) in %s mode", len(pending), len(themes), mode, extra={"debug": debug})
+            revisions = get_revisions()
+            run_llm = llm
+            if regenerate_button:
+                # A new revision misses the cached jingles and the uncached endpoint skips the response
+                # cache; in high-quality mode the research is still reused through do_research
+                for theme in pending:
+                    revisions[(theme, mode, endpoint_url)] = revisions.get((theme, mode, endpoint_url), 0) + 1
+                run_llm = init_llm(hf_api_key, endpoint_url, False)
+            theme_revisions = {theme: revisions.get((theme, mode, endpoint_url), 0) for theme in pending}
 
-            copywriter = Agent(
-                role="Copywriter",
-                goal="Refine and polish the jingle content for clarity, impact, and radio-friendliness.",
-                backstory="You are a professional copywriter with experience in advertising. Ensure it's persuasive, error-free, and optimized for spoken delivery.",
-                verbose=True,
-                llm=llm
-            )
+            if len(pending) == 1:
+                theme = pending[0]
+                generate = functools.partial(generate_jingle, _verbose=debug) if high_quality else generate_jingle_fast
+                results[theme] = stream_jingle(generate, theme, theme_revisions[theme], run_llm)
+            elif pending:
+                batch = generate_batch(pending, theme_revisions, run_llm, high_quality, debug)
+                results.update(zip(pending, asyncio.run(batch)))
+            if semantic_cache:
+                for theme in pending:
+                    semantic_cache.add(theme, results[theme], mode=mode, endpoint_url=endpoint_url)
 
-            # Define Tasks
-            research_task = Task(
-                description=f"Research '{theme}'. List 5 key points for an engaging jingle.",
-                expected_output="A bullet-point list of research findings.",
-                agent=researcher
-            )
-
-            create_task = Task(
-                description=f"Using the research, create a short radio jingle for '{theme}'. Include lyrics and notes on rhythm/timing.",
-                expected_output="The jingle lyrics with structure (e.g., verse, chorus). Keep it concise.",
-                agent=creator,
-                context=[research_task]
-            )
-
-            copywrite_task = Task(
-                description=f"Refine the created jingle for '{theme}'. Improve flow, add punch, ensure it's radio-ready.",
-                expected_output="The final polished jingle script.",
-                agent=copywriter,
-                context=[create_task]
-            )
-
-            # Assemble Crew
-            crew = Crew(
-                agents=[researcher, creator, copywriter],
-                tasks=[research_task, create_task, copywrite_task],
-                verbose=True
-            )
-
-            # Run the crew with retry logic
-            @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-            def run_crew():
-                try:
-                    return crew.kickoff()
-                except Exception as inner_e:
-                    raise Exception(f"Crew execution failed: {str(inner_e)}")
-
-            result = run_crew()
-
-            # Display results
+            st.session_state["outputs"] = tuple((theme, *results[theme]) for theme in themes)
             st.success("Jingle generated!")
-            st.subheader("Final Polished Jingle")
-            st.text(result)
-
-            # Optional: Display intermediate results
-            with st.expander("View Research Findings"):
-                st.text(crew.tasks[0].output.raw_output)
-            with st.expander("View Initial Creation"):
-                st.text(crew.tasks[1].output.raw_output)
 
         except Exception as e:
+            logger.warning("Jingle generation failed", exc_info=True, extra={"debug": debug})
             st.error(f"An error occurred while generating the jingle: {str(e)}")
+
+render_outputs()